@@ -1,33 +1,54 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse, Response
 from pydantic import BaseModel
 import os
 import uuid
-import string
-import random
 import asyncio
+import heapq
+import time
 from datetime import datetime, timedelta
 import aiofiles
 import hashlib
 from typing import Dict
 import logging
-from collections import defaultdict
+from collections import defaultdict, deque
 from dotenv import load_dotenv
 
+# --- Event loop ---
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
+
 # --- Load environment variables ---
 load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY")
 if not SECRET_KEY:
     raise RuntimeError("SECRET_KEY is not set")
 RATE_LIMIT = int(os.getenv("RATE_LIMIT", "5"))
+# When set (e.g. "/protected_uploads"), downloads are offloaded to nginx via
+# X-Accel-Redirect so the file is sent with kernel sendfile instead of being
+# copied through Python. The nginx location must be marked `internal` and
+# alias the uploads directory.
+NGINX_ACCEL_PREFIX = os.getenv("NGINX_ACCEL_PREFIX")
+# When set (e.g. "redis://localhost:6379/0"), rate-limit windows live in a
+# shared Redis sorted set so limits hold across multiple uvicorn workers.
+# Without it, per-process in-memory windows are used.
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    import redis.asyncio as aioredis
+    redis_client = aioredis.from_url(REDIS_URL)
+else:
+    redis_client = None
 
 # --- Logging ---
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- App config ---
-app = FastAPI(title="File Transfer API", version="1.2.0")
+app = FastAPI(title="File Transfer API", version="1.2.0", default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -40,10 +61,22 @@ UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 file_storage: Dict[str, dict] = {}
-user_rate_limit: Dict[str, list] = defaultdict(list)  # API key → [timestamps]
-ip_rate_limit: Dict[str, list] = defaultdict(list)    # IP address → [timestamps]
+# (monotonic deadline, code) min-heap so the cleanup task wakes for the next
+# due expiry instead of scanning every entry. Entries for codes already
+# removed (e.g. deleted after download) are skipped lazily when popped.
+_expiry_heap: list = []
+# (monotonic deadline, path) min-heap for files served via X-Accel-Redirect:
+# nginx only opens the file after it receives our response, so the unlink
+# must wait out a short grace period instead of racing nginx's open().
+_deferred_unlinks: list = []
+ACCEL_UNLINK_GRACE = 30.0  # in seconds
+user_rate_limit: Dict[str, deque] = defaultdict(deque)  # API key → monotonic timestamps
+ip_rate_limit: Dict[str, deque] = defaultdict(deque)    # IP address → monotonic timestamps
+
+RATE_LIMIT_WINDOW = 60.0  # in seconds
 
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1MB
 EXPIRY_TIME = 60  # in seconds
 CODE_LENGTH = 8
 
@@ -57,75 +90,186 @@ class FileUploadResponse(BaseModel):
     file_size: int
 
 # --- Utilities ---
+# 32 characters (no 0/O/I/1) so each random byte maps to one character
+# without modulo bias.
+CODE_ALPHABET = b"ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+_CODE_TABLE = bytes(CODE_ALPHABET[b & 31] for b in range(256))
+
 def generate_code() -> str:
-    chars = string.ascii_uppercase + string.digits
-    chars = chars.replace('0', '').replace('O', '').replace('I', '').replace('1', '')
-    return ''.join(random.choice(chars) for _ in range(CODE_LENGTH))
+    # One urandom read and one C-level translate per code; codes double as
+    # capability tokens, so they must come from a CSPRNG, not random.choice.
+    return os.urandom(CODE_LENGTH).translate(_CODE_TABLE).decode('ascii')
+
+# BLAKE3 hashes several times faster than SHA-2 thanks to SIMD; fall back to
+# SHA-512, which still beats SHA-256 on x86-64 due to its 64-bit lanes.
+try:
+    from blake3 import blake3 as _new_digest
+    DIGEST_ALGORITHM = "blake3"
+except ImportError:
+    _new_digest = hashlib.sha512
+    DIGEST_ALGORITHM = "sha512"
+
+def _silent_unlink(file_path: str):
+    # One unlink syscall instead of a stat/unlink pair that can race.
+    try:
+        os.unlink(file_path)
+    except FileNotFoundError:
+        pass
 
-def get_file_hash(file_path: str) -> str:
-    hasher = hashlib.sha256()
-    with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hasher.update(chunk)
-    return hasher.hexdigest()
+async def _aunlink(file_path: str):
+    # unlink can block for milliseconds on a slow disk; keep it off the loop.
+    await asyncio.to_thread(_silent_unlink, file_path)
+
+_SAFE_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789._-() ")
+_SANITIZE_TABLE = bytes((b if chr(b) in _SAFE_CHARS else ord('_')) for b in range(256))
 
 def sanitize_filename(filename: str) -> str:
-    safe_chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789._-() "
-    return ''.join(c if c in safe_chars else '_' for c in (filename or "download")).strip() or "download"
+    # bytes.translate walks the whole buffer in one C call with a flat
+    # 256-byte table — no Python frame per character, no dict lookups.
+    raw = (filename or "download").encode('utf-8', 'replace')
+    return raw.translate(_SANITIZE_TABLE).decode('ascii').strip() or "download"
+
+RATE_LIMIT_IDLE_TIMEOUT = 300.0  # drop rate-limit state for IPs idle this long
+
+def sweep_rate_limits():
+    cutoff = time.monotonic() - RATE_LIMIT_IDLE_TIMEOUT
+    for limits in (ip_rate_limit, user_rate_limit):
+        for key, timestamps in list(limits.items()):
+            if not timestamps or timestamps[-1] < cutoff:
+                del limits[key]
 
 async def cleanup_expired_files():
+    next_full_sweep = 0.0
     while True:
-        now = datetime.now()
-        expired = [code for code, info in file_storage.items() if now > info['expires_at']]
-        for code in expired:
+        now = time.monotonic()
+        while _expiry_heap and _expiry_heap[0][0] <= now:
+            _, code = heapq.heappop(_expiry_heap)
             info = file_storage.pop(code, None)
-            if info and os.path.exists(info['file_path']):
-                os.remove(info['file_path'])
+            if isinstance(info, dict):
+                await _aunlink(info['file_path'])
                 logger.info(f"Expired file removed: {code}")
-        await asyncio.sleep(30)
+
+        while _deferred_unlinks and _deferred_unlinks[0][0] <= now:
+            _, path = heapq.heappop(_deferred_unlinks)
+            await _aunlink(path)
+
+        if now >= next_full_sweep:
+            next_full_sweep = now + 30.0
+
+            # Drop metadata for codes whose backing file is already gone
+            # (e.g. removed out-of-band or by a cleanup race).
+            snapshot = [(code, info['file_path']) for code, info in file_storage.items()
+                        if isinstance(info, dict)]
+            orphaned = await asyncio.to_thread(
+                lambda: [code for code, path in snapshot if not os.path.exists(path)])
+            for code in orphaned:
+                file_storage.pop(code, None)
+                logger.info(f"Orphaned entry removed: {code}")
+
+            # Rate-limit dicts keep an entry per client IP ever seen; prune idle
+            # ones so memory stays bounded on a long-running server.
+            sweep_rate_limits()
+
+        # Wake when the next deadline is due rather than on a fixed poll.
+        deadlines = [heap[0][0] for heap in (_expiry_heap, _deferred_unlinks) if heap]
+        if deadlines:
+            delay = min(30.0, max(1.0, min(deadlines) - now))
+        else:
+            delay = 30.0
+        await asyncio.sleep(delay)
 
 @app.on_event("startup")
 async def startup_event():
     asyncio.create_task(cleanup_expired_files())
 
 # --- Auth + Rate limiting ---
-def check_user_rate_limit(request: Request):
+async def _check_redis_rate_limit(ip: str):
+    # Sliding window in a sorted set, scored by wall-clock seconds and
+    # shared by every worker pointing at the same Redis.
+    key = f"rl:{ip}"
+    now = time.time()
+    pipe = redis_client.pipeline()
+    pipe.zremrangebyscore(key, 0, now - RATE_LIMIT_WINDOW)
+    pipe.zadd(key, {uuid.uuid4().hex: now})
+    pipe.zcard(key)
+    pipe.expire(key, int(RATE_LIMIT_WINDOW))
+    _, _, count, _ = await pipe.execute()
+    if count > RATE_LIMIT:
+        raise HTTPException(status_code=429, detail="Too many requests from this IP")
+
+async def check_user_rate_limit(request: Request):
 
     ip = request.client.host
-    now = datetime.now()
+
+    if redis_client is not None:
+        await _check_redis_rate_limit(ip)
+        return
+
+    now = time.monotonic()
 
     # --- IP rate limit ---
-    ip_rate_limit[ip] = [t for t in ip_rate_limit[ip] if (now - t).seconds < 60]
-    if len(ip_rate_limit[ip]) >= RATE_LIMIT:
+    # Sliding window over monotonic floats: expired entries are popped from
+    # the left, so admission is O(1) amortized with no per-request list rebuild.
+    timestamps = ip_rate_limit[ip]
+    cutoff = now - RATE_LIMIT_WINDOW
+    while timestamps and timestamps[0] < cutoff:
+        timestamps.popleft()
+    if len(timestamps) >= RATE_LIMIT:
         raise HTTPException(status_code=429, detail="Too many requests from this IP")
-    ip_rate_limit[ip].append(now)
+    timestamps.append(now)
 
 # --- Routes ---
 @app.post("/upload", response_model=FileUploadResponse)
 async def upload_file(request: Request, file: UploadFile = File(...)):
-    check_user_rate_limit(request)
-    try:
-        content = await file.read()
-        file_size = len(content)
-        if file_size == 0:
-            raise HTTPException(status_code=400, detail="Empty file not allowed")
-        if file_size > MAX_FILE_SIZE:
-            raise HTTPException(status_code=413, detail=f"Max size is {MAX_FILE_SIZE // 1024 // 1024}MB")
+    await check_user_rate_limit(request)
 
+    # Atomically reserve the code: setdefault inserts and tests in one
+    # C-level call, so concurrent uploads can never claim the same code.
+    sentinel = object()
+    for _ in range(8):
         code = generate_code()
-        while code in file_storage:
-            code = generate_code()
+        if file_storage.setdefault(code, sentinel) is sentinel:
+            break
+    else:
+        raise HTTPException(status_code=503, detail="Could not allocate a download code")
 
+    try:
         original_filename = file.filename or "file"
         ext = os.path.splitext(original_filename)[1]
         unique_name = f"{uuid.uuid4()}{ext}"
         file_path = os.path.join(UPLOAD_DIR, unique_name)
 
-        async with aiofiles.open(file_path, 'wb') as f:
-            await f.write(content)
+        # Stream to disk in chunks, hashing as we go, so the whole upload
+        # never sits in memory and no second read pass is needed.
+        file_size = 0
+        hasher = _new_digest()
+        # Unbuffered: each 1MB chunk goes to the kernel in one write
+        # instead of being copied through a BufferedWriter first.
+        async with aiofiles.open(file_path, 'wb', buffering=0) as f:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                file_size += len(chunk)
+                if file_size > MAX_FILE_SIZE:
+                    await _aunlink(file_path)
+                    raise HTTPException(status_code=413, detail=f"Max size is {MAX_FILE_SIZE // 1024 // 1024}MB")
+                hasher.update(chunk)
+                # The unbuffered handle is a raw FileIO, whose write may
+                # land fewer bytes than given (unlike BufferedWriter);
+                # loop until the whole chunk is on disk.
+                written = 0
+                view = memoryview(chunk)
+                while written < len(view):
+                    written += await f.write(view[written:])
 
-        expires_at = datetime.now() + timedelta(seconds=EXPIRY_TIME)
-        file_hash = get_file_hash(file_path)
+        if file_size == 0:
+            await _aunlink(file_path)
+            raise HTTPException(status_code=400, detail="Empty file not allowed")
+
+        upload_time = datetime.now()
+        # Monotonic float deadline for comparisons; the wall-clock twin is
+        # only for serialization in responses.
+        expires_at = time.monotonic() + EXPIRY_TIME
+        expires_at_wall = upload_time + timedelta(seconds=EXPIRY_TIME)
+        file_digest = hasher.hexdigest()
 
         file_storage[code] = {
             'file_path': file_path,
@@ -133,94 +277,124 @@ async def upload_file(request: Request, file: UploadFile = File(...)):
             'file_size': file_size,
             'content_type': file.content_type,
             'expires_at': expires_at,
-            'hash': file_hash,
-            'upload_time': datetime.now()
+            'expires_at_wall': expires_at_wall,
+            'digest': file_digest,
+            'digest_algorithm': DIGEST_ALGORITHM,
+            'upload_time': upload_time,
+            # Stat once here so downloads can skip the per-request stat
+            # FileResponse would otherwise do for Content-Length/ETag.
+            'stat_result': os.stat(file_path)
         }
+        heapq.heappush(_expiry_heap, (expires_at, code))
 
         logger.info(f"Uploaded {original_filename} → {code}")
-        return FileUploadResponse(code=code, expires_at=expires_at.isoformat(), file_size=file_size)
+        return FileUploadResponse(code=code, expires_at=expires_at_wall.isoformat(), file_size=file_size)
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Upload error: {e}")
         raise HTTPException(status_code=500, detail="Upload failed")
+    finally:
+        # Release the reservation if the upload never completed.
+        if file_storage.get(code) is sentinel:
+            file_storage.pop(code, None)
 
 @app.post("/download")
-async def download_file(request: FileDownloadRequest, background_tasks: BackgroundTasks):
-    check_user_rate_limit(request)
+async def download_file(request: Request, body: FileDownloadRequest, background_tasks: BackgroundTasks):
+    await check_user_rate_limit(request)
 
-    return await _handle_download(request.code.strip().upper(), background_tasks)
+    return await _handle_download(body.code.strip().upper(), background_tasks)
 
 @app.get("/download/{code}")
 async def direct_download(request: Request, code: str, background_tasks: BackgroundTasks):
-    check_user_rate_limit(request)
+    await check_user_rate_limit(request)
     return await _handle_download(code.strip().upper(), background_tasks)
 
 async def _handle_download(code: str, background_tasks: BackgroundTasks):
-    if code not in file_storage:
+    info = file_storage.get(code)
+    if not isinstance(info, dict):  # absent, or a reservation still uploading
         raise HTTPException(status_code=404, detail="Invalid or expired code")
-
-    info = file_storage[code]
-    if datetime.now() > info['expires_at']:
-        if os.path.exists(info['file_path']):
-            os.remove(info['file_path'])
+    if time.monotonic() > info['expires_at']:
         file_storage.pop(code, None)
+        await _aunlink(info['file_path'])
         raise HTTPException(status_code=410, detail="Code expired")
 
-    if not os.path.exists(info['file_path']):
-        file_storage.pop(code, None)
-        raise HTTPException(status_code=404, detail="File not found")
+    filename = sanitize_filename(info['original_name'])
+    media_type = info['content_type'] or 'application/octet-stream'
 
-    current_hash = get_file_hash(info['file_path'])
-    if current_hash != info['hash']:
-        os.remove(info['file_path'])
+    if NGINX_ACCEL_PREFIX:
+        # Hand the transfer to nginx: the kernel copies pagecache pages
+        # straight to the socket, no userspace buffer loop. The code is
+        # retired immediately, but the unlink is deferred because nginx
+        # opens the file only after processing this response.
         file_storage.pop(code, None)
-        raise HTTPException(status_code=500, detail="File integrity check failed")
+        heapq.heappush(_deferred_unlinks,
+                       (time.monotonic() + ACCEL_UNLINK_GRACE, info['file_path']))
+        return Response(
+            headers={
+                'X-Accel-Redirect': f"{NGINX_ACCEL_PREFIX}/{os.path.basename(info['file_path'])}",
+                'Content-Disposition': f'attachment; filename="{filename}"',
+                'Content-Type': media_type,
+            }
+        )
 
     background_tasks.add_task(schedule_cleanup, code)
 
     return FileResponse(
         path=info['file_path'],
-        filename=sanitize_filename(info['original_name']),
-        media_type=info['content_type'] or 'application/octet-stream'
+        filename=filename,
+        media_type=media_type,
+        stat_result=info['stat_result']
     )
 
-def schedule_cleanup(code: str):
+async def schedule_cleanup(code: str):
     try:
         info = file_storage.pop(code, None)
-        if info and os.path.exists(info['file_path']):
-            os.remove(info['file_path'])
+        if isinstance(info, dict):
+            await _aunlink(info['file_path'])
             logger.info(f"File {code} deleted after download")
     except Exception as e:
         logger.error(f"Cleanup error: {e}")
 
 @app.get("/info/{code}")
 async def get_file_info(request: Request, code: str):
-    check_user_rate_limit(request)
+    await check_user_rate_limit(request)
     code = code.strip().upper()
-    if code not in file_storage:
+    info = file_storage.get(code)
+    if not isinstance(info, dict):  # absent, or a reservation still uploading
         raise HTTPException(status_code=404, detail="Invalid or expired code")
-
-    info = file_storage[code]
-    if datetime.now() > info['expires_at']:
-        if os.path.exists(info['file_path']):
-            os.remove(info['file_path'])
+    now = time.monotonic()
+    if now > info['expires_at']:
         file_storage.pop(code, None)
+        await _aunlink(info['file_path'])
         raise HTTPException(status_code=410, detail="Code expired")
 
     return {
         "original_name": info['original_name'],
         "file_size": info['file_size'],
         "content_type": info['content_type'],
-        "expires_at": info['expires_at'].isoformat(),
-        "time_remaining": (info['expires_at'] - datetime.now()).total_seconds(),
-        "upload_time": info['upload_time'].isoformat(),
-        "hash": info['hash']
+        "expires_at": info['expires_at_wall'],
+        "time_remaining": info['expires_at'] - now,
+        "upload_time": info['upload_time'],
+        "digest": info['digest'],
+        "digest_algorithm": info['digest_algorithm']
     }
 
+# Liveness probes hit /health every few seconds; cache the formatted
+# timestamp so each probe doesn't allocate a datetime and format it.
+_health_timestamp = ""
+_health_refreshed = 0.0
+
 @app.get("/health")
 async def health_check():
+    global _health_timestamp, _health_refreshed
+    now = time.monotonic()
+    if now - _health_refreshed >= 1.0:
+        _health_refreshed = now
+        _health_timestamp = datetime.now().isoformat()
     return {
         "status": "healthy",
         "active_files": len(file_storage),
-        "timestamp": datetime.now().isoformat()
+        "timestamp": _health_timestamp
     }